@@ -1,11 +1,43 @@
 #!/usr/bin/python
 
+import copy
 import os
+import threading
 
 from converter.avcodecs import video_codec_list, audio_codec_list, subtitle_codec_list
-from converter.formats import format_list
+from converter.avcodecs import video_codec_map, audio_codec_map, subtitle_codec_map
+from converter.formats import format_list, format_map
 from converter.ffmpeg import FFMpeg, FFMpegError, FFMpegConvertError
 
+# Maximum number of probe results and full option lists kept by
+# each Converter.
+_PROBE_CACHE_SIZE = 128
+_OPTLIST_CACHE_SIZE = 128
+
+
+def _freeze(value):
+    """
+    Convert a (possibly nested) options dict into a hashable cache key.
+    Values are keyed together with their type, as 1 == True == 1.0.
+    Raises TypeError if the options contain unhashable values.
+    """
+    if isinstance(value, dict):
+        return frozenset((k, type(v), _freeze(v)) for k, v in value.items())
+    hash(value)
+    return value
+
+
+def _cache_store(cache, lock, key, value, maxsize):
+    """
+    Store value in a bounded cache dict, evicting the oldest entry (on
+    Python 2, an arbitrary one) if it's full. The lock serializes
+    evictions, so concurrent stores never drop the same key twice.
+    """
+    with lock:
+        if key not in cache and len(cache) >= maxsize:
+            del cache[next(iter(cache))]
+        cache[key] = value
+
 
 class ConverterError(Exception):
     pass
@@ -25,34 +57,85 @@ class Converter(object):
 
         self.ffmpeg = FFMpeg(ffmpeg_path=ffmpeg_path,
                              ffprobe_path=ffprobe_path)
-        self.video_codecs = {}
-        self.audio_codecs = {}
-        self.subtitle_codecs = {}
-        self.formats = {}
-
-        for cls in audio_codec_list:
-            name = cls.codec_name
-            self.audio_codecs[name] = cls
+        self.video_codecs = video_codec_map.copy()
+        self.audio_codecs = audio_codec_map.copy()
+        self.subtitle_codecs = subtitle_codec_map.copy()
+        self.formats = format_map.copy()
+        # codec/format instances, created on first use; the classes
+        # keep no per-call state, so one instance per class is enough
+        self._instances = {}
+        self._probe_cache = {}
+        self._optlist_cache = {}
+        self._cache_lock = threading.Lock()
+
+    def parse_options(self, opt, twopass=None, src_width=None,
+                      src_height=None):
+        """
+        Parse format/codec options and prepare raw ffmpeg option list.
 
-        for cls in video_codec_list:
-            name = cls.codec_name
-            self.video_codecs[name] = cls
+        Source video dimensions, if known, can be passed in src_width and
+        src_height; they're added to a copy of the video options and used
+        for aspect ratio corrections.
 
-        for cls in subtitle_codec_list:
-            name = cls.codec_name
-            self.subtitle_codecs[name] = cls
+        Results are cached per Converter, so converting many files with
+        the same options only parses them once. The cache is keyed on the
+        format and codec classes the options resolve to as well, so codecs
+        registered on this Converter later take effect immediately.
+        Attributes changed on a codec or format class after it has been
+        used aren't noticed, so register a subclass instead.
+        """
+        if not isinstance(opt, dict):
+            raise ConverterError('Invalid output specification')
 
-        for cls in format_list:
-            name = cls.format_name
-            self.formats[name] = cls
+        streams = self._stream_options(opt, twopass)
+        try:
+            key = (_freeze(opt), self._resolve_classes(opt, streams),
+                   twopass, src_width, src_height)
+        except TypeError:
+            return self._parse_options(opt, streams, twopass, src_width,
+                                       src_height)
+
+        optlist = self._optlist_cache.get(key)
+        if optlist is None:
+            optlist = tuple(self._parse_options(opt, streams, twopass,
+                                                src_width, src_height))
+            _cache_store(self._optlist_cache, self._cache_lock, key, optlist,
+                         _OPTLIST_CACHE_SIZE)
+
+        return list(optlist)
+
+    @staticmethod
+    def _stream_options(opt, twopass):
+        """
+        Return the audio, video and subtitle options to use, defaulting
+        to the null codec for missing streams and for audio in the first
+        pass.
+        """
+        if 'audio' in opt and twopass != 1:
+            opt_audio = opt['audio']
+        else:
+            opt_audio = {'codec': None}
+        return (opt_audio, opt.get('video', {'codec': None}),
+                opt.get('subtitle', {'codec': None}))
 
-    def parse_options(self, opt, twopass=None):
+    def _resolve_classes(self, opt, streams):
         """
-        Parse format/codec options and prepare raw ffmpeg option list.
+        Return the format and audio/video/subtitle codec classes that
+        the options (and stream options) resolve to, or None for those
+        that can't be resolved.
         """
-        if not isinstance(opt, dict):
-            raise ConverterError('Invalid output specification')
+        registries = (self.audio_codecs, self.video_codecs,
+                      self.subtitle_codecs)
+
+        classes = [self.formats.get(opt.get('format'))]
+        for codecs, stream in zip(registries, streams):
+            if isinstance(stream, dict):
+                classes.append(codecs.get(stream.get('codec')))
+            else:
+                classes.append(None)
+        return tuple(classes)
 
+    def _parse_options(self, opt, streams, twopass, src_width, src_height):
         if 'format' not in opt:
             raise ConverterError('Format not specified')
 
@@ -60,59 +143,35 @@ class Converter(object):
         if f not in self.formats:
             raise ConverterError('Requested unknown format: ' + str(f))
 
-        format_options = self.formats[f]().parse_options(opt)
+        format_options = self._instance(self.formats[f]).parse_options(opt)
         if format_options is None:
             raise ConverterError('Unknown container format error')
 
+        # first pass only needs the encoder statistics, so skip muxing
+        if twopass == 1:
+            format_options = ['-f', 'null']
+
         if 'audio' not in opt and 'video' not in opt:
             raise ConverterError('Neither audio nor video streams requested')
 
-        # audio options
-        if 'audio' not in opt or twopass == 1:
-            opt_audio = {'codec': None}
-        else:
-            opt_audio = opt['audio']
-            if not isinstance(opt_audio, dict) or 'codec' not in opt_audio:
-                raise ConverterError('Invalid audio codec specification')
-
-        c = opt_audio['codec']
-        if c not in self.audio_codecs:
-            raise ConverterError('Requested unknown audio codec ' + str(c))
+        opt_audio, opt_video, opt_subtitle = streams
 
-        audio_options = self.audio_codecs[c]().parse_options(opt_audio)
-        if audio_options is None:
-            raise ConverterError('Unknown audio codec error')
+        # audio options
+        audio_options = self._parse_codec_options(self.audio_codecs, 'audio',
+                                                  opt_audio)
 
         # video options
-        if 'video' not in opt:
-            opt_video = {'codec': None}
-        else:
-            opt_video = opt['video']
-            if not isinstance(opt_video, dict) or 'codec' not in opt_video:
-                raise ConverterError('Invalid video codec specification')
-
-        c = opt_video['codec']
-        if c not in self.video_codecs:
-            raise ConverterError('Requested unknown video codec ' + str(c))
-
-        video_options = self.video_codecs[c]().parse_options(opt_video)
-        if video_options is None:
-            raise ConverterError('Unknown video codec error')
-
-        if 'subtitle' not in opt:
-            opt_subtitle = {'codec': None}
-        else:
-            opt_subtitle = opt['subtitle']
-            if not isinstance(opt_subtitle, dict) or 'codec' not in opt_subtitle:
-                raise ConverterError('Invalid subtitle codec specification')
-
-        c = opt_subtitle['codec']
-        if c not in self.subtitle_codecs:
-            raise ConverterError('Requested unknown subtitle codec ' + str(c))
-
-        subtitle_options = self.subtitle_codecs[c]().parse_options(opt_subtitle)
-        if subtitle_options is None:
-            raise ConverterError('Unknown subtitle codec error')
+        if (isinstance(opt_video, dict) and src_width is not None and
+                src_height is not None):
+            opt_video = opt_video.copy()
+            opt_video['src_width'] = src_width
+            opt_video['src_height'] = src_height
+        video_options = self._parse_codec_options(self.video_codecs, 'video',
+                                                  opt_video)
+
+        # subtitle options
+        subtitle_options = self._parse_codec_options(self.subtitle_codecs,
+                                                     'subtitle', opt_subtitle)
 
         if 'map' in opt:
             m = opt['map']
@@ -132,11 +191,39 @@ class Converter(object):
 
         return optlist
 
+    def _instance(self, cls):
+        """
+        Return this Converter's instance of a codec or format class.
+        """
+        inst = self._instances.get(cls)
+        if inst is None:
+            inst = self._instances[cls] = cls()
+        return inst
+
+    def _parse_codec_options(self, codecs, kind, opt):
+        """
+        Validate options for one stream kind (audio, video or subtitle)
+        and return the ffmpeg options produced by the requested codec
+        from the codecs registry.
+        """
+        if not isinstance(opt, dict) or 'codec' not in opt:
+            raise ConverterError('Invalid %s codec specification' % kind)
+
+        c = opt['codec']
+        if c not in codecs:
+            raise ConverterError('Requested unknown %s codec %s' % (kind, c))
+
+        optlist = self._instance(codecs[c]).parse_options(opt)
+        if optlist is None:
+            raise ConverterError('Unknown %s codec error' % kind)
+        return optlist
+
     def convert(self, infile, outfile, options, twopass=False, timeout=10):
         """
         Convert media file (infile) according to specified options, and
         save it to outfile. For two-pass encoding, specify the pass (1 or 2)
-        in the twopass parameter.
+        in the twopass parameter. The first pass is run without audio and
+        with the null muxer, writing to os.devnull.
 
         Options should be passed as a dictionary. The keys are:
             * format (mandatory, string) - container format; see
@@ -175,43 +262,83 @@ class Converter(object):
         ...   pass # can be used to inform the user about the progress
         """
 
+        info, src_width, src_height = self._probe_source(infile, options)
+
+        # progress percentage per second of content; ffmpeg may report
+        # timecodes slightly past the probed duration, so clamp to each
+        # pass's end
+        scale = 100.0 / info.format.duration
+
+        if twopass:
+            half = scale / 2
+            optlist1 = self.parse_options(options, 1, src_width, src_height)
+            for timecode in self.ffmpeg.convert(infile, os.devnull, optlist1,
+                                                timeout=timeout):
+                yield min(50, int(timecode * half))
+
+            optlist2 = self.parse_options(options, 2, src_width, src_height)
+            for timecode in self.ffmpeg.convert(infile, outfile, optlist2,
+                                                timeout=timeout):
+                yield min(100, int(50.0 + timecode * half))
+        else:
+            optlist = self.parse_options(options, twopass, src_width,
+                                         src_height)
+            for timecode in self.ffmpeg.convert(infile, outfile, optlist,
+                                                timeout=timeout):
+                yield min(100, int(timecode * scale))
+
+    def convert_async(self, infile, outfile, options, twopass=False,
+                      timeout=10):
+        """
+        Asynchronous version of convert(), for use with asyncio (requires
+        Python 3.6 or newer). Arguments are the same as for convert(), and
+        the returned asynchronous generator yields the same progress
+        values.
+
+        Since ffmpeg is run as an asyncio subprocess, several conversions
+        can run concurrently in one thread, e.g. using asyncio.gather().
+        Each two-pass job keeps its first pass statistics in its own
+        temporary log file. The timeout doesn't use signals, so it's safe
+        to use in threads.
+
+        >>> async def run(conv):
+        ...     async for timecode in conv:
+        ...         pass
+
+        >>> c = Converter()
+        >>> loop.run_until_complete(asyncio.gather(
+        ...     run(c.convert_async('test1.ogg', '/tmp/output1.mkv', opts)),
+        ...     run(c.convert_async('test2.ogg', '/tmp/output2.mkv', opts))))
+        """
+        from converter.aio import convert_async
+        return convert_async(self, infile, outfile, options, twopass,
+                             timeout)
+
+    def _probe_source(self, infile, options):
+        """
+        Validate conversion input and probe the source file. Returns the
+        MediaInfo and the source video dimensions (or None if the source
+        has no video).
+        """
         if not isinstance(options, dict):
             raise ConverterError('Invalid options')
 
         if not os.path.exists(infile):
             raise ConverterError("Source file doesn't exist: " + infile)
 
-        info = self.ffmpeg.probe(infile)
+        info = self.probe(infile)
         if info is None:
             raise ConverterError("Can't get information about source file")
 
         if not info.video and not info.audio:
             raise ConverterError('Source file has no audio or video streams')
 
-        if info.video and 'video' in options:
-            options = options.copy()
-            v = options['video'] = options['video'].copy()
-            v['src_width'] = info.video.video_width
-            v['src_height'] = info.video.video_height
-
         if info.format.duration < 0.01:
             raise ConverterError('Zero-length media')
 
-        if twopass:
-            optlist1 = self.parse_options(options, 1)
-            for timecode in self.ffmpeg.convert(infile, outfile, optlist1,
-                                                timeout=timeout):
-                yield int((50.0 * timecode) / info.format.duration)
-
-            optlist2 = self.parse_options(options, 2)
-            for timecode in self.ffmpeg.convert(infile, outfile, optlist2,
-                                                timeout=timeout):
-                yield int(50.0 + (50.0 * timecode) / info.format.duration)
-        else:
-            optlist = self.parse_options(options, twopass)
-            for timecode in self.ffmpeg.convert(infile, outfile, optlist,
-                                                timeout=timeout):
-                yield int((100.0 * timecode) / info.format.duration)
+        if info.video:
+            return info, info.video.video_width, info.video.video_height
+        return info, None, None
 
     def probe(self, fname, posters_as_video=True):
         """
@@ -220,8 +347,29 @@ class Converter(object):
 
         :param posters_as_video: Take poster images (mainly for audio files) as
             A video stream, defaults to True
+
+        Results are cached per Converter, keyed on the file path, size and
+        modification time, so probing the same unchanged file again doesn't
+        spawn ffprobe. Each call returns its own copy of the cached result,
+        so callers can modify it freely.
         """
-        return self.ffmpeg.probe(fname, posters_as_video)
+        try:
+            st = os.stat(fname)
+        except OSError:
+            return self.ffmpeg.probe(fname, posters_as_video)
+
+        # st_mtime_ns (Python 3.3+) doesn't lose precision to floats
+        mtime = getattr(st, 'st_mtime_ns', st.st_mtime)
+        key = (os.path.abspath(fname), mtime, st.st_size, posters_as_video)
+        info = self._probe_cache.get(key)
+        if info is None:
+            info = self.ffmpeg.probe(fname, posters_as_video)
+            if info is None:
+                return None
+            _cache_store(self._probe_cache, self._cache_lock, key, info,
+                         _PROBE_CACHE_SIZE)
+
+        return copy.deepcopy(info)
 
     def thumbnail(self, fname, time, outfile, size=None, quality=FFMpeg.DEFAULT_JPEG_QUALITY):
         """
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+asyncio support for running conversions concurrently. Requires Python 3.6
+or newer; use Converter.convert_async() rather than importing this module
+directly.
+"""
+
+import asyncio
+import codecs
+import os
+import shutil
+import tempfile
+
+from converter.ffmpeg import FFMpegError, console_encoding, logger
+
+
+async def ffmpeg_convert(ffmpeg, infile, outfile, opts, timeout=10):
+    """
+    Asynchronous version of FFMpeg.convert(), yielding the timecode of the
+    currently processed part of the file.
+    """
+    if not os.path.exists(infile):
+        raise FFMpegError("Input file doesn't exist: " + infile)
+
+    cmds = ffmpeg._convert_cmds(infile, outfile, opts)
+
+    logger.debug('Spawning ffmpeg with command: ' + ' '.join(cmds))
+    try:
+        p = await asyncio.create_subprocess_exec(
+            *cmds, stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    except OSError:
+        raise FFMpegError('Error while calling ffmpeg binary')
+
+    decoder = codecs.getincrementaldecoder(console_encoding)()
+    yielded = False
+    buf = ''
+    total_output = ''
+    try:
+        while True:
+            try:
+                ret = await asyncio.wait_for(p.stderr.read(1024), timeout)
+            except asyncio.TimeoutError:
+                raise FFMpegError('timed out while waiting for ffmpeg')
+
+            if not ret:
+                break
+
+            ret = decoder.decode(ret)
+            total_output += ret
+            buf += ret
+            while '\r' in buf:
+                line, buf = buf.split('\r', 1)
+
+                timecode = ffmpeg._parse_timecode(line)
+                if timecode is not None:
+                    yielded = True
+                    yield timecode
+
+        await p.communicate()  # wait for process to exit
+    finally:
+        # timed out, cancelled or abandoned by the consumer
+        if p.returncode is None:
+            p.kill()
+            await p.wait()
+
+    ffmpeg._check_convert_output(cmds, infile, total_output, yielded,
+                                 p.pid, p.returncode)
+
+
+async def convert_async(converter, infile, outfile, options, twopass=False,
+                        timeout=10):
+    """
+    Implementation of Converter.convert_async(); see its documentation
+    for details.
+    """
+    # probing spawns ffprobe synchronously, so keep it off the event loop
+    loop = asyncio.get_event_loop()
+    info, src_width, src_height = await loop.run_in_executor(
+        None, converter._probe_source, infile, options)
+
+    # progress percentage per second of content; ffmpeg may report
+    # timecodes slightly past the probed duration, so clamp to each
+    # pass's end
+    scale = 100.0 / info.format.duration
+
+    # 0 means no timeout, as in convert()
+    timeout = timeout or None
+
+    if twopass:
+        # concurrent jobs would overwrite each other's first pass
+        # statistics in ffmpeg's default log file, so use our own
+        logdir = tempfile.mkdtemp(prefix='ffmpeg2pass')
+        passlog = ['-passlogfile', os.path.join(logdir, 'ffmpeg2pass')]
+        passes = [
+            (converter.parse_options(options, 1, src_width, src_height) +
+             passlog, os.devnull, 0.0, scale / 2, 50),
+            (converter.parse_options(options, 2, src_width, src_height) +
+             passlog, outfile, 50.0, scale / 2, 100),
+        ]
+    else:
+        logdir = None
+        passes = [
+            (converter.parse_options(options, twopass, src_width, src_height),
+             outfile, 0.0, scale, 100),
+        ]
+
+    try:
+        for optlist, dest, offset, pass_scale, end in passes:
+            conv = ffmpeg_convert(converter.ffmpeg, infile, dest, optlist,
+                                  timeout)
+            try:
+                async for timecode in conv:
+                    yield min(end, int(offset + timecode * pass_scale))
+            finally:
+                await conv.aclose()
+    finally:
+        if logdir is not None:
+            shutil.rmtree(logdir, ignore_errors=True)
@@ -1,12 +1,152 @@
 #!/usr/bin/env python
 
-
-class BaseCodec(object):
+try:
+    from sys import intern
+except ImportError:  # Python 2 has it as a builtin
+    pass
+
+# Exceptions raised by the option typecasts (int(), str(), ...) on
+# invalid values
+_CAST_ERRORS = (TypeError, ValueError, OverflowError)
+
+
+def _compile_safe_options(encoder_spec, encoder_ranges, option_flags=None):
+    """
+    Generate a specialized safe_options function for the given
+    encoder spec ((option, type) pairs), with a straight-line typecast
+    (and range check, for options listed in encoder_ranges) for each
+    known option instead of a generic loop over the input.
+
+    If option_flags is given, the generated function also emits the
+    ffmpeg switches for those options in the same pass, and returns
+    a (safe, optlist) tuple.
+    """
+    flags = dict((k, (intern(flag), fmt))
+                 for k, flag, fmt in option_flags or ())
+    if option_flags:
+        # emit switches in option_flags order
+        order = [k for k, _, _ in option_flags]
+        encoder_spec = sorted(encoder_spec, key=lambda item: (
+            order.index(item[0]) if item[0] in flags else len(order)))
+
+    ns = {'_missing': object(), '_cast_errors': _CAST_ERRORS}
+    src = ['def _fast_safe(opts):', '    safe = {}']
+    if option_flags:
+        src.append('    optlist = []')
+    for i, (k, typ) in enumerate(encoder_spec):
+        ns['_t%d' % i] = typ
+        if k in flags:
+            ns['_f%d' % i] = flags[k][0]
+        src.extend([
+            '    v = opts.get(%r, _missing)' % k,
+            '    if v is not _missing:',
+            '        if type(v) is not _t%d:' % i,
+            '            try:',
+            '                v = _t%d(v)' % i,
+            '            except _cast_errors:',
+            '                v = _missing',
+        ])
+        if k in encoder_ranges:
+            src.append('        if v is not _missing and %r <= v <= %r:' %
+                       encoder_ranges[k])
+        else:
+            src.append('        if v is not _missing:')
+        src.append('            safe[%r] = v' % k)
+        if option_flags and k in flags:
+            src.append('            optlist += (_f%d, %r %% v)' %
+                       (i, flags[k][1]))
+
+    if option_flags:
+        src.append('    return safe, optlist')
+    else:
+        src.append('    return safe')
+    exec('\n'.join(src), ns)
+    return ns['_fast_safe']
+
+
+def _compile_emitter(option_flags):
+    """
+    Generate a function that turns (safe) options into ffmpeg switches,
+    according to option_flags ((option, switch, value format) triples),
+    as straight-line code with no per-call loop.
+    """
+    ns = {}
+    src = ['def _emit(safe):', '    optlist = []']
+    for i, (k, flag, fmt) in enumerate(option_flags):
+        ns['_f%d' % i] = intern(flag)
+        src.extend([
+            '    v = safe.get(%r)' % k,
+            '    if v is not None:',
+            '        optlist += (_f%d, %r %% v)' % (i, fmt),
+        ])
+    src.append('    return optlist')
+    exec('\n'.join(src), ns)
+    return ns['_emit']
+
+
+class _CodecMeta(type):
+    """
+    Freezes encoder_options into an (option, type) spec and compiles
+    the safe_options fast path and the option_flags emitter for each
+    codec class when the class is created (ie. after the class body has
+    copied/updated the options inherited from its parent).
+    """
+
+    def __init__(cls, name, bases, attrs):
+        super(_CodecMeta, cls).__init__(name, bases, attrs)
+        cls._encoder_spec = tuple(cls.encoder_options.items())
+        cls._ranges_spec = tuple(cls.encoder_ranges.items())
+        cls._fast_safe = staticmethod(
+            _compile_safe_options(cls._encoder_spec, cls.encoder_ranges))
+        cls._compiled_encoder_options = cls.encoder_options
+        cls._compiled_encoder_ranges = cls.encoder_ranges
+        cls._compiled_option_flags = cls.option_flags
+        cls._emit = staticmethod(_compile_emitter(cls.option_flags))
+        cls._emit_codec_specific = staticmethod(
+            _compile_emitter(cls.codec_option_flags))
+
+        # Casting, range checking and emitting option_flags switches can
+        # be fused into one pass for classes that use it (_fuse_options),
+        # unless the class has its own safe_options, or a
+        # _codec_specific_parse_options hook to run in between
+        hook_owners = [k for k in cls.__mro__
+                       if '_codec_specific_parse_options' in vars(k)]
+        cls._has_parse_hook = len(hook_owners) > 1
+        safe_owners = [k for k in cls.__mro__ if 'safe_options' in vars(k)]
+        if (cls._has_parse_hook or len(safe_owners) > 1 or
+                not cls._fuse_options):
+            cls._fast_parse = None
+        else:
+            cls._fast_parse = staticmethod(_compile_safe_options(
+                cls._encoder_spec, cls.encoder_ranges, cls.option_flags))
+
+
+# Works as a metaclass declaration on both Python 2 and 3
+_Codec = _CodecMeta('_Codec', (object,), {
+    'encoder_options': {}, 'encoder_ranges': {}, 'option_flags': (),
+    'codec_option_flags': (), '_fuse_options': False})
+
+
+class BaseCodec(_Codec):
     """
     Base audio/video codec class.
+
+    The encoder_options, encoder_ranges, option_flags and
+    codec_option_flags attributes are processed when the class is
+    created, so subclasses should define them in the class body.
+    encoder_options or encoder_ranges changed later (on the class or
+    an instance) are still honoured, using slower generic code.
     """
 
     encoder_options = {}
+    # (min, max) allowed values for numeric options; out-of-range
+    # values are dropped by safe_options
+    encoder_ranges = {}
+    # (option, ffmpeg switch, value format) for options that map directly
+    # to a single ffmpeg switch
+    option_flags = ()
+    # same, for codec-specific options added after the general ones
+    codec_option_flags = ()
     codec_name = None
     ffmpeg_codec_name = None
 
@@ -19,20 +159,63 @@ class BaseCodec(object):
         return safe
 
     def _codec_specific_produce_ffmpeg_list(self, safe):
-        return []
+        return self._emit_codec_specific(safe)
+
+    def _compiled_options_current(self):
+        """
+        Check that encoder_options and encoder_ranges are still the dicts
+        the class was compiled from, unchanged.
+        """
+        return (self.encoder_options is self._compiled_encoder_options and
+                self.encoder_ranges is self._compiled_encoder_ranges and
+                tuple(self.encoder_options.items()) == self._encoder_spec and
+                tuple(self.encoder_ranges.items()) == self._ranges_spec)
+
+    def _fused_safe_options(self, opts):
+        """
+        Return (safe options, option_flags switches) computed in a single
+        pass, or None if the class or instance needs the separate
+        safe_options / _codec_specific_parse_options / _emit steps.
+        """
+        if (self._fast_parse is None or
+                self.option_flags is not self._compiled_option_flags or
+                not self._compiled_options_current()):
+            return None
+        return self._fast_parse(opts)
+
+    def _emit_option_flags(self, safe):
+        """
+        Return the option_flags switches for the safe options.
+        """
+        if self.option_flags is self._compiled_option_flags:
+            return self._emit(safe)
+        # overridden on the instance
+        return _compile_emitter(self.option_flags)(safe)
 
     def safe_options(self, opts):
+        # Use the precompiled version unless the options have been
+        # overridden or modified since the class was created
+        if self._compiled_options_current():
+            return self._fast_safe(opts)
+
         safe = {}
 
-        # Only copy options that are expected and of correct type
-        # (and do typecasting on them)
-        for k, v in opts.items():
-            if k in self.encoder_options:
-                typ = self.encoder_options[k]
+        # Only copy options that are expected, of correct type
+        # and in allowed range (and do typecasting on them)
+        for k, typ in self.encoder_options.items():
+            if k not in opts:
+                continue
+            v = opts[k]
+            if type(v) is not typ:
                 try:
-                    safe[k] = typ(v)
-                except:
-                    pass
+                    v = typ(v)
+                except _CAST_ERRORS:
+                    continue
+            if k in self.encoder_ranges:
+                lo, hi = self.encoder_ranges[k]
+                if not lo <= v <= hi:
+                    continue
+            safe[k] = v
 
         return safe
 
@@ -57,37 +240,36 @@ class AudioCodec(BaseCodec):
         'samplerate': int
     }
 
-    def parse_options(self, opt):
-        super(AudioCodec, self).parse_options(opt)
+    encoder_ranges = {
+        'channels': (1, 12),
+        'bitrate': (8, 512),
+        'samplerate': (1000, 50000),
+    }
 
-        safe = self.safe_options(opt)
+    option_flags = (
+        ('channels', '-ac', '%d'),
+        ('bitrate', '-ab', '%dk'),
+        ('samplerate', '-ar', '%d'),
+    )
 
-        if 'channels' in safe:
-            c = safe['channels']
-            if c < 1 or c > 12:
-                del safe['channels']
+    # parse_options uses _fused_safe_options
+    _fuse_options = True
 
-        if 'bitrate' in safe:
-            br = safe['bitrate']
-            if br < 8 or br > 512:
-                del safe['bitrate']
+    def parse_options(self, opt):
+        super(AudioCodec, self).parse_options(opt)
 
-        if 'samplerate' in safe:
-            f = safe['samplerate']
-            if f < 1000 or f > 50000:
-                del safe['samplerate']
+        optlist = ['-acodec', self.ffmpeg_codec_name]
 
-        safe = self._codec_specific_parse_options(safe)
+        fused = self._fused_safe_options(opt)
+        if fused is None:
+            safe = self.safe_options(opt)
+            safe = self._codec_specific_parse_options(safe)
+            optlist += self._emit_option_flags(safe)
+        else:
+            safe, flags = fused
+            optlist += flags
 
-        optlist = ['-acodec', self.ffmpeg_codec_name]
-        if 'channels' in safe:
-            optlist.extend(['-ac', str(safe['channels'])])
-        if 'bitrate' in safe:
-            optlist.extend(['-ab', str(safe['bitrate']) + 'k'])
-        if 'samplerate' in safe:
-            optlist.extend(['-ar', str(safe['samplerate'])])
-
-        optlist.extend(self._codec_specific_produce_ffmpeg_list(safe))
+        optlist += self._codec_specific_produce_ffmpeg_list(safe)
         return optlist
 
 
@@ -110,20 +292,15 @@ class SubtitleCodec(BaseCodec):
         'default': int
     }
 
+    encoder_ranges = {
+        'forced': (0, 1),
+        'default': (0, 1),
+    }
+
     def parse_options(self, opt):
         super(SubtitleCodec, self).parse_options(opt)
         safe = self.safe_options(opt)
 
-        if 'forced' in safe:
-            f = safe['forced']
-            if f < 0 or f > 1:
-                del safe['forced']
-
-        if 'default' in safe:
-            d = safe['default']
-            if d < 0 or d > 1:
-                del safe['default']
-
         if 'language' in safe:
             l = safe['language']
             if len(l) > 3:
@@ -133,10 +310,57 @@ class SubtitleCodec(BaseCodec):
 
         optlist = ['-scodec', self.ffmpeg_codec_name]
 
-        optlist.extend(self._codec_specific_produce_ffmpeg_list(safe))
+        optlist += self._codec_specific_produce_ffmpeg_list(safe)
         return optlist
 
 
+def _aspect_stretch(sw, sh, w, h):
+    return w, h, None
+
+
+def _aspect_crop(sw, sh, w, h):
+    wsh = w * sh
+    hsw = h * sw
+
+    # source is taller, need to crop top/bottom
+    if wsh > hsw:  # target is taller
+        h0 = wsh // sw
+        if h0 == h:  # differs only by rounding
+            return w, h, None
+        dh = (h0 - h) // 2
+        return w, h0, 'crop=%d:%d:0:%d' % (w, h, dh)
+    else:  # source is wider, need to crop left/right
+        w0 = hsw // sh
+        assert w0 > w, (sw, sh, w, h)
+        dw = (w0 - w) // 2
+        return w0, h, 'crop=%d:%d:%d:0' % (w, h, dw)
+
+
+def _aspect_pad(sw, sh, w, h):
+    wsh = w * sh
+    hsw = h * sw
+
+    # target is taller, need to pad top/bottom
+    if wsh < hsw:
+        h1 = wsh // sw
+        assert h1 < h, (sw, sh, w, h)
+        dh = (h - h1) // 2
+        return w, h1, 'pad=%d:%d:0:%d' % (w, h, dh)  # FIXED
+    else:  # target is wider, need to pad left/right
+        w1 = hsw // sh
+        assert w1 < w, (sw, sh, w, h)
+        dw = (w - w1) // 2
+        return w1, h, 'pad=%d:%d:%d:0' % (w, h, dw)  # FIXED
+
+
+# Aspect preserval mode -> handler returning (w, h, filters)
+_ASPECT_HANDLERS = {
+    'stretch': _aspect_stretch,
+    'crop': _aspect_crop,
+    'pad': _aspect_pad,
+}
+
+
 class VideoCodec(BaseCodec):
     """
     Base video codec class handles general video options. Possible
@@ -177,91 +401,54 @@ class VideoCodec(BaseCodec):
         'src_height': int,
     }
 
+    encoder_ranges = {
+        'fps': (1, 120),
+        'bitrate': (16, 15000),
+        'width': (16, 4000),
+        'height': (16, 3000),
+    }
+
+    option_flags = (
+        ('fps', '-r', '%d'),
+        ('bitrate', '-vb', '%dk'),
+    )
+
     def _aspect_corrections(self, sw, sh, w, h, mode):
         # If we don't have source info, we don't try to calculate
         # aspect corrections
         if not sw or not sh:
             return w, h, None
 
-        # Original aspect ratio
-        aspect = (1.0 * sw) / (1.0 * sh)
+        # Aspect ratios are compared by cross-multiplying (w/h vs sw/sh)
+        # so everything stays in integer arithmetic
 
         # If we have only one dimension, we can easily calculate
         # the other to match the source aspect ratio
         if not w and not h:
             return w, h, None
         elif w and not h:
-            h = int((1.0 * w) / aspect)
+            h = (w * sh) // sw
             return w, h, None
         elif h and not w:
-            w = int(aspect * h)
+            w = (h * sw) // sh
             return w, h, None
 
         # If source and target dimensions are actually the same aspect
         # ratio, we've got nothing to do
-        if int(aspect * h) == w:
+        if (h * sw) // sh == w:
             return w, h, None
 
-        if mode == 'stretch':
-            return w, h, None
-
-        target_aspect = (1.0 * w) / (1.0 * h)
-
-        if mode == 'crop':
-            # source is taller, need to crop top/bottom
-            if target_aspect > aspect:  # target is taller
-                h0 = int(w / aspect)
-                assert h0 > h, (sw, sh, w, h)
-                dh = (h0 - h) / 2
-                return w, h0, 'crop=%d:%d:0:%d' % (w, h, dh)
-            else:  # source is wider, need to crop left/right
-                w0 = int(h * aspect)
-                assert w0 > w, (sw, sh, w, h)
-                dw = (w0 - w) / 2
-                return w0, h, 'crop=%d:%d:%d:0' % (w, h, dw)
-
-        if mode == 'pad':
-            # target is taller, need to pad top/bottom
-            if target_aspect < aspect:
-                h1 = int(w / aspect)
-                assert h1 < h, (sw, sh, w, h)
-                dh = (h - h1) / 2
-                return w, h1, 'pad=%d:%d:0:%d' % (w, h, dh)  # FIXED
-            else:  # target is wider, need to pad left/right
-                w1 = int(h * aspect)
-                assert w1 < w, (sw, sh, w, h)
-                dw = (w - w1) / 2
-                return w1, h, 'pad=%d:%d:%d:0' % (w, h, dw)  # FIXED
-
-        assert False, mode
+        handler = _ASPECT_HANDLERS.get(mode)
+        assert handler is not None, mode
+        return handler(sw, sh, w, h)
 
     def parse_options(self, opt):
         super(VideoCodec, self).parse_options(opt)
 
         safe = self.safe_options(opt)
 
-        if 'fps' in safe:
-            f = safe['fps']
-            if f < 1 or f > 120:
-                del safe['fps']
-
-        if 'bitrate' in safe:
-            br = safe['bitrate']
-            if br < 16 or br > 15000:
-                del safe['bitrate']
-
-        w = None
-        h = None
-
-        if 'width' in safe:
-            w = safe['width']
-            if w < 16 or w > 4000:
-                w = None
-
-        if 'height' in safe:
-            h = safe['height']
-            if h < 16 or h > 3000:
-                h = None
+        w = safe.get('width')
+        h = safe.get('height')
 
         sw = None
         sh = None
@@ -273,10 +460,9 @@ class VideoCodec(BaseCodec):
                 sw = None
                 sh = None
 
-        mode = 'stretch'
-        if 'mode' in safe:
-            if safe['mode'] in ['stretch', 'crop', 'pad']:
-                mode = safe['mode']
+        mode = safe.get('mode')
+        if mode not in _ASPECT_HANDLERS:
+            mode = 'stretch'
 
         ow, oh = w, h  # FIXED
         w, h, filters = self._aspect_corrections(sw, sh, w, h, mode)
@@ -288,27 +474,25 @@ class VideoCodec(BaseCodec):
         if w and h:
             safe['aspect'] = '%d:%d' % (w, h)
 
-        safe = self._codec_specific_parse_options(safe)
-
-        w = safe['width']
-        h = safe['height']
-        filters = safe['aspect_filters']
+        # Only codecs with their own hook (eg. MPEG) can change these
+        if self._has_parse_hook:
+            safe = self._codec_specific_parse_options(safe)
+            w = safe['width']
+            h = safe['height']
+            filters = safe['aspect_filters']
 
         optlist = ['-vcodec', self.ffmpeg_codec_name]
-        if 'fps' in safe:
-            optlist.extend(['-r', str(safe['fps'])])
-        if 'bitrate' in safe:
-            optlist.extend(['-vb', str(safe['bitrate']) + 'k'])  # FIXED
+        optlist += self._emit_option_flags(safe)
         if w and h:
-            optlist.extend(['-s', '%dx%d' % (w, h)])
+            optlist += ('-s', '%dx%d' % (w, h))
 
             if ow and oh:
-                optlist.extend(['-aspect', '%d:%d' % (ow, oh)])
+                optlist += ('-aspect', '%d:%d' % (ow, oh))
 
         if filters:
-            optlist.extend(['-vf', filters])
+            optlist += ('-vf', filters)
 
-        optlist.extend(self._codec_specific_produce_ffmpeg_list(safe))
+        optlist += self._codec_specific_produce_ffmpeg_list(safe)
         return optlist
 
 
@@ -317,9 +501,10 @@ class AudioNullCodec(BaseCodec):
     Null audio codec (no audio).
     """
     codec_name = None
+    ffmpeg_options = ('-an',)
 
     def parse_options(self, opt):
-        return ['-an']
+        return list(self.ffmpeg_options)
 
 
 class VideoNullCodec(BaseCodec):
@@ -328,9 +513,10 @@ class VideoNullCodec(BaseCodec):
     """
 
     codec_name = None
+    ffmpeg_options = ('-vn',)
 
     def parse_options(self, opt):
-        return ['-vn']
+        return list(self.ffmpeg_options)
 
 
 class SubtitleNullCodec(BaseCodec):
@@ -339,9 +525,10 @@ class SubtitleNullCodec(BaseCodec):
     """
 
     codec_name = None
+    ffmpeg_options = ('-sn',)
 
     def parse_options(self, opt):
-        return ['-sn']
+        return list(self.ffmpeg_options)
 
 
 class AudioCopyCodec(BaseCodec):
@@ -349,9 +536,10 @@ class AudioCopyCodec(BaseCodec):
     Copy audio stream directly from the source.
     """
     codec_name = 'copy'
+    ffmpeg_options = ('-acodec', 'copy')
 
     def parse_options(self, opt):
-        return ['-acodec', 'copy']
+        return list(self.ffmpeg_options)
 
 
 class VideoCopyCodec(BaseCodec):
@@ -359,9 +547,10 @@ class VideoCopyCodec(BaseCodec):
     Copy video stream directly from the source.
     """
     codec_name = 'copy'
+    ffmpeg_options = ('-vcodec', 'copy')
 
     def parse_options(self, opt):
-        return ['-vcodec', 'copy']
+        return list(self.ffmpeg_options)
 
 
 class SubtitleCopyCodec(BaseCodec):
@@ -369,11 +558,17 @@ class SubtitleCopyCodec(BaseCodec):
     Copy subtitle stream directly from the source.
     """
     codec_name = 'copy'
+    ffmpeg_options = ('-scodec', 'copy')
 
     def parse_options(self, opt):
-        return ['-scodec', 'copy']
+        return list(self.ffmpeg_options)
 
 # Audio Codecs
+
+# Needed by ffmpeg builds where the native AAC encoder is experimental
+_AAC_EXPERIMENTAL = ('-strict', 'experimental')
+
+
 class VorbisCodec(AudioCodec):
     """
     Vorbis audio codec.
@@ -387,11 +582,9 @@ class VorbisCodec(AudioCodec):
         # 3-6 is a good range to try. Default is 3
     })
 
-    def _codec_specific_produce_ffmpeg_list(self, safe):
-        optlist = []
-        if 'quality' in safe:
-            optlist.extend(['-qscale:a', safe['quality']])
-        return optlist
+    codec_option_flags = (
+        ('quality', '-qscale:a', '%d'),
+    )
 
 
 class AacCodec(AudioCodec):
@@ -400,10 +593,10 @@ class AacCodec(AudioCodec):
     """
     codec_name = 'aac'
     ffmpeg_codec_name = 'aac'
-    aac_experimental_enable = ['-strict', 'experimental']
+    aac_experimental_enable = _AAC_EXPERIMENTAL
 
     def _codec_specific_produce_ffmpeg_list(self, safe):
-        return self.aac_experimental_enable
+        return list(self.aac_experimental_enable)
 
 
 class FdkAacCodec(AudioCodec):
@@ -468,11 +661,9 @@ class TheoraCodec(VideoCodec):
         # 5-7 is a good range to try (default is 200k bitrate)
     })
 
-    def _codec_specific_produce_ffmpeg_list(self, safe):
-        optlist = []
-        if 'quality' in safe:
-            optlist.extend(['-qscale:v', safe['quality']])
-        return optlist
+    codec_option_flags = (
+        ('quality', '-qscale:v', '%d'),
+    )
 
 
 class H264Codec(VideoCodec):
@@ -493,17 +684,12 @@ class H264Codec(VideoCodec):
         'tune': str,  # default: not-set, for valid values see above link
     })
 
-    def _codec_specific_produce_ffmpeg_list(self, safe):
-        optlist = []
-        if 'preset' in safe:
-            optlist.extend(['-preset', safe['preset']])
-        if 'quality' in safe:
-            optlist.extend(['-crf', safe['quality']])
-        if 'profile' in safe:
-            optlist.extend(['-profile', safe['profile']])
-        if 'tune' in safe:
-            optlist.extend(['-tune', safe['tune']])
-        return optlist
+    codec_option_flags = (
+        ('preset', '-preset', '%s'),
+        ('quality', '-crf', '%d'),
+        ('profile', '-profile', '%s'),
+        ('tune', '-tune', '%s'),
+    )
 
 
 class DivxCodec(VideoCodec):
@@ -553,12 +739,10 @@ class MpegCodec(VideoCodec):
 
         if w and h:
             filters = safe['aspect_filters']
-            tmp = 'aspect=%d:%d' % (w, h)
-
             if filters is None:
-                safe['aspect_filters'] = tmp
+                safe['aspect_filters'] = 'aspect=%d:%d' % (w, h)
             else:
-                safe['aspect_filters'] = tmp + ',' + filters
+                safe['aspect_filters'] = 'aspect=%d:%d,%s' % (w, h, filters)
 
         return safe
 
@@ -635,3 +819,8 @@ subtitle_codec_list = [
     SubtitleNullCodec, SubtitleCopyCodec, MOVTextCodec, SSA, SubRip, DVDSub,
     DVBSub
 ]
+
+# Codec name -> class lookup tables (null codecs are keyed by None)
+audio_codec_map = dict((c.codec_name, c) for c in audio_codec_list)
+video_codec_map = dict((c.codec_name, c) for c in video_codec_list)
+subtitle_codec_map = dict((c.codec_name, c) for c in subtitle_codec_list)
@@ -12,6 +12,9 @@ logger = logging.getLogger(__name__)
 
 console_encoding = locale.getdefaultlocale()[1] or 'UTF-8'
 
+# Progress timecode in ffmpeg output
+_TIMECODE_RE = re.compile(r'time=([0-9.:]+) ')
+
 
 class FFMpegError(Exception):
     pass
@@ -129,14 +132,14 @@ class MediaStreamInfo(object):
     def parse_float(val, default=0.0):
         try:
             return float(val)
-        except:
+        except (TypeError, ValueError):
             return default
 
     @staticmethod
     def parse_int(val, default=0):
         try:
             return int(val)
-        except:
+        except (TypeError, ValueError):
             return default
 
     def parse_ffprobe(self, key, val):
@@ -418,9 +421,7 @@ class FFMpeg(object):
         if not os.path.exists(infile):
             raise FFMpegError("Input file doesn't exist: " + infile)
 
-        cmds = [self.ffmpeg_path, '-i', infile]
-        cmds.extend(opts)
-        cmds.extend(['-y', outfile])
+        cmds = self._convert_cmds(infile, outfile, opts)
 
         if timeout:
             def on_sigalrm(*_):
@@ -437,7 +438,6 @@ class FFMpeg(object):
         yielded = False
         buf = ''
         total_output = ''
-        pat = re.compile(r'time=([0-9.:]+) ')
         while True:
             if timeout:
                 signal.alarm(timeout)
@@ -456,15 +456,8 @@ class FFMpeg(object):
             if '\r' in buf:
                 line, buf = buf.split('\r', 1)
 
-                tmp = pat.findall(line)
-                if len(tmp) == 1:
-                    timespec = tmp[0]
-                    if ':' in timespec:
-                        timecode = 0
-                        for part in timespec.split(':'):
-                            timecode = 60 * timecode + float(part)
-                    else:
-                        timecode = float(tmp[0])
+                timecode = self._parse_timecode(line)
+                if timecode is not None:
                     yielded = True
                     yield timecode
 
@@ -473,6 +466,41 @@ class FFMpeg(object):
 
         p.communicate()  # wait for process to exit
 
+        self._check_convert_output(cmds, infile, total_output, yielded,
+                                   p.pid, p.returncode)
+
+    def _convert_cmds(self, infile, outfile, opts):
+        cmds = [self.ffmpeg_path, '-i', infile]
+        cmds.extend(opts)
+        cmds.extend(['-y', outfile])
+        return cmds
+
+    @staticmethod
+    def _parse_timecode(line):
+        """
+        Return the timecode (in seconds) reported in a line of ffmpeg
+        progress output, or None if there isn't one.
+        """
+        tmp = _TIMECODE_RE.findall(line)
+        if len(tmp) != 1:
+            return None
+
+        timespec = tmp[0]
+        if ':' in timespec:
+            timecode = 0
+            for part in timespec.split(':'):
+                timecode = 60 * timecode + float(part)
+        else:
+            timecode = float(timespec)
+        return timecode
+
+    @staticmethod
+    def _check_convert_output(cmds, infile, total_output, yielded, pid,
+                              returncode):
+        """
+        Raise an appropriate exception if the output and exit code of a
+        finished ffmpeg conversion indicate an error.
+        """
         if total_output == '':
             raise FFMpegError('Error while calling ffmpeg binary')
 
@@ -482,20 +510,20 @@ class FFMpeg(object):
 
             if line.startswith('Received signal'):
                 # Received signal 15: terminating.
-                raise FFMpegConvertError(line.split(':')[0], cmd, total_output, pid=p.pid)
+                raise FFMpegConvertError(line.split(':')[0], cmd, total_output, pid=pid)
             if line.startswith(infile + ': '):
                 err = line[len(infile) + 2:]
                 raise FFMpegConvertError('Encoding error', cmd, total_output,
-                                         err, pid=p.pid)
+                                         err, pid=pid)
             if line.startswith('Error while '):
                 raise FFMpegConvertError('Encoding error', cmd, total_output,
-                                         line, pid=p.pid)
+                                         line, pid=pid)
             if not yielded:
                 raise FFMpegConvertError('Unknown ffmpeg error', cmd,
-                                         total_output, line, pid=p.pid)
-        if p.returncode != 0:
-            raise FFMpegConvertError('Exited with code %d' % p.returncode, cmd,
-                                     total_output, pid=p.pid)
+                                         total_output, line, pid=pid)
+        if returncode != 0:
+            raise FFMpegConvertError('Exited with code %d' % returncode, cmd,
+                                     total_output, pid=pid)
 
     def thumbnail(self, fname, time, outfile, size=None, quality=DEFAULT_JPEG_QUALITY):
         """
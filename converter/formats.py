@@ -96,3 +96,6 @@ format_list = [
     OggFormat, AviFormat, MkvFormat, WebmFormat, FlvFormat,
     MovFormat, Mp4Format, MpegFormat, Mp3Format
 ]
+
+# Format name -> class lookup table
+format_map = dict((f.format_name, f) for f in format_list)
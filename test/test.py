@@ -33,6 +33,26 @@ def verify_progress(p):
     return True
 
 
+def consume_async(agen):
+    """
+    Drive an asynchronous generator to completion on a new event loop and
+    return the list of values it yielded.
+    """
+    import asyncio
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        li = []
+        while True:
+            try:
+                li.append(loop.run_until_complete(agen.__anext__()))
+            except StopAsyncIteration:
+                return li
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
 class TestFFMpeg(unittest.TestCase):
     def setUp(self):
         current_dir = os.path.abspath(os.path.dirname(__file__))
@@ -205,6 +225,14 @@ class TestFFMpeg(unittest.TestCase):
         self.assertEqual({}, c.safe_options({'baz': 1, 'quux': 1, 'foo': 'w00t'}))
         self.assertEqual({'foo': 42, 'bar': False}, c.safe_options({'foo': '42', 'bar': 0}))
 
+        # options added after the class was created are still honoured
+        class DoctestH264Codec(avcodecs.H264Codec):
+            encoder_options = avcodecs.H264Codec.encoder_options.copy()
+
+        DoctestH264Codec.encoder_options['level'] = str
+        self.assertEqual({'codec': 'h264', 'level': '3.1'},
+                         DoctestH264Codec().safe_options({'codec': 'h264', 'level': 3.1}))
+
         c = avcodecs.AudioCodec()
         c.codec_name = 'doctest'
         c.ffmpeg_codec_name = 'doctest'
@@ -215,6 +243,20 @@ class TestFFMpeg(unittest.TestCase):
         self.assertEqual(['-acodec', 'doctest', '-ac', '1', '-ab', '64k', '-ar', '44100'],
                          c.parse_options({'codec': 'doctest', 'channels': '1', 'bitrate': '64', 'samplerate': '44100'}))
 
+        # subclasses and instances can still override safe_options and the option tables
+        class DoctestMonoVorbisCodec(avcodecs.VorbisCodec):
+            def safe_options(self, opts):
+                safe = super(DoctestMonoVorbisCodec, self).safe_options(opts)
+                safe['channels'] = 1
+                return safe
+
+        self.assertEqual(['-acodec', 'libvorbis', '-ac', '1'],
+                         DoctestMonoVorbisCodec().parse_options({'codec': 'vorbis', 'channels': 2}))
+
+        c = avcodecs.VorbisCodec()
+        c.encoder_ranges = {'channels': (1, 32)}
+        self.assertEqual(['-acodec', 'libvorbis', '-ac', '20'], c.parse_options({'codec': 'vorbis', 'channels': 20}))
+
         c = avcodecs.VideoCodec()
         c.codec_name = 'doctest'
         c.ffmpeg_codec_name = 'doctest'
@@ -234,6 +276,19 @@ class TestFFMpeg(unittest.TestCase):
                          c.parse_options({'codec': 'doctest', 'src_width': 640, 'src_height': 480, 'mode': 'crop',
                                           'width': 320, 'height': 200}))
 
+        # target aspect differs from the source only by rounding, no crop needed
+        self.assertEqual(['-vcodec', 'doctest', '-s', '107x60', '-aspect', '107:60'],
+                         c.parse_options({'codec': 'doctest', 'src_width': 1920, 'src_height': 1080, 'mode': 'crop',
+                                          'width': 107, 'height': 60}))
+
+        self.assertEqual(['-vcodec', 'doctest', '-s', '57x32', '-aspect', '57:32'],
+                         c.parse_options({'codec': 'doctest', 'src_width': 1280, 'src_height': 720, 'mode': 'crop',
+                                          'width': 57, 'height': 32}))
+
+        self.assertEqual(['-vcodec', 'doctest', '-s', '43x32', '-aspect', '43:32'],
+                         c.parse_options({'codec': 'doctest', 'src_width': 640, 'src_height': 480, 'mode': 'crop',
+                                          'width': 43, 'height': 32}))
+
         self.assertEqual(['-vcodec', 'doctest', '-s', '320x200', '-aspect', '320:240', '-vf', 'pad=320:240:0:20'],
                          c.parse_options({'codec': 'doctest', 'src_width': 640, 'src_height': 400, 'mode': 'pad',
                                           'width': 320, 'height': 240}))
@@ -248,6 +303,19 @@ class TestFFMpeg(unittest.TestCase):
         self.assertEqual(['-vcodec', 'doctest', '-s', '320x240'],
                          c.parse_options({'codec': 'doctest', 'src_width': 640, 'src_height': 480, 'height': 240}))
 
+        self.assertEqual(['-acodec', 'libvorbis', '-qscale:a', '5'],
+                         avcodecs.VorbisCodec().parse_options({'codec': 'vorbis', 'quality': '5'}))
+        self.assertEqual(['-vcodec', 'libtheora', '-qscale:v', '7'],
+                         avcodecs.TheoraCodec().parse_options({'codec': 'theora', 'quality': 7}))
+        self.assertEqual(['-vcodec', 'libx264', '-preset', 'fast', '-crf', '23'],
+                         avcodecs.H264Codec().parse_options({'codec': 'h264', 'quality': 23, 'preset': 'fast'}))
+
+        c = avcodecs.MOVTextCodec()
+        self.assertEqual({'codec': 'mov_text', 'forced': 1, 'default': 0},
+                         c.safe_options({'codec': 'mov_text', 'forced': '1', 'default': 0}))
+        self.assertEqual({'codec': 'mov_text'},
+                         c.safe_options({'codec': 'mov_text', 'forced': 2, 'default': -1}))
+
     def test_converter(self):
         c = Converter()
 
@@ -266,6 +334,24 @@ class TestFFMpeg(unittest.TestCase):
         self.assertEqual(['-acodec', 'copy', '-vcodec', 'copy', '-sn', '-f', 'ogg'],
                          c.parse_options({'format': 'ogg', 'audio': {'codec': 'copy'}, 'video': {'codec': 'copy'}, 'subtitle': {'codec': None}}))
 
+        # first pass of two-pass encoding skips audio and muxing
+        options = {'format': 'ogg', 'audio': {'codec': 'vorbis'}, 'video': {'codec': 'theora', 'quality': 7}}
+        self.assertEqual(['-an', '-vcodec', 'libtheora', '-qscale:v', '7', '-sn', '-f', 'null', '-pass', '1'],
+                         c.parse_options(options, twopass=1))
+        self.assertEqual(['-acodec', 'libvorbis', '-vcodec', 'libtheora', '-qscale:v', '7', '-sn', '-f', 'ogg',
+                          '-pass', '2'],
+                         c.parse_options(options, twopass=2))
+
+        # codecs registered on the Converter replace cached option lists
+        class DoctestVorbisCodec(avcodecs.VorbisCodec):
+            ffmpeg_codec_name = 'doctest'
+
+        options = {'format': 'ogg', 'audio': {'codec': 'vorbis'}}
+        self.assertEqual(['-acodec', 'libvorbis', '-vn', '-sn', '-f', 'ogg'], c.parse_options(options))
+        c.audio_codecs['vorbis'] = DoctestVorbisCodec
+        self.assertEqual(['-acodec', 'doctest', '-vn', '-sn', '-f', 'ogg'], c.parse_options(options))
+        self.assertEqual(['-acodec', 'libvorbis', '-vn', '-sn', '-f', 'ogg'], Converter().parse_options(options))
+
         info = c.probe('test1.ogg')
         self.assertEqual('theora', info.video.codec)
         self.assertEqual(720, info.video.video_width)
@@ -296,6 +382,44 @@ class TestFFMpeg(unittest.TestCase):
 
         self.assertTrue(verify_progress(conv))
 
+    def test_converter_async(self):
+        if sys.version_info < (3, 6):
+            return  # convert_async() needs asynchronous generators
+
+        c = Converter()
+        options = {
+            'format': 'ogg',
+            'audio': {'codec': 'vorbis', 'samplerate': 11025, 'channels': 1, 'bitrate': 16},
+            'video': {'codec': 'theora', 'bitrate': 128, 'width': 360, 'height': 200, 'fps': 15}
+        }
+
+        conv = c.convert_async('test1.ogg', self.video_file_path, options)
+        self.assertTrue(verify_progress(consume_async(conv)))
+        self._assert_converted_video_file()
+
+        self.ensure_notexist(self.video_file_path)
+        conv = c.convert_async('test1.ogg', self.video_file_path, options, twopass=True)
+        self.assertTrue(verify_progress(consume_async(conv)))
+        self._assert_converted_video_file()
+
+    def test_converter_progress(self):
+        c = Converter()
+
+        # sub-second media, with ffmpeg reporting timecodes up to (and
+        # past) the probed duration
+        info = ffmpeg.MediaInfo()
+        info.format.duration = 0.29
+        stream = ffmpeg.MediaStreamInfo()
+        stream.type = 'audio'
+        info.streams.append(stream)
+        c.probe = lambda fname, posters_as_video=True: info
+        c.ffmpeg.convert = lambda infile, outfile, opts, timeout=10: iter([0.1, 0.2, 0.29, 0.3])
+
+        options = {'format': 'mp3', 'audio': {'codec': 'mp3'}}
+        self.assertEqual([34, 68, 100, 100], list(c.convert('test.aac', self.audio_file_path, options)))
+        self.assertEqual([17, 34, 50, 50, 67, 84, 100, 100],
+                         list(c.convert('test.aac', self.audio_file_path, options, twopass=True)))
+
     def test_converter_2pass(self):
         c = Converter()
         self.video_file_path = 'xx.ogg'
@@ -326,6 +450,23 @@ class TestFFMpeg(unittest.TestCase):
 
         self.assertTrue(verify_progress(conv))
 
+    def test_converter_probe_cache(self):
+        c = Converter()
+
+        info = c.probe('test1.ogg')
+        info.video.video_width = 1
+
+        # cached results are copied, so changes don't leak into later calls
+        info2 = c.probe('test1.ogg')
+        self.assertFalse(info is info2)
+        self.assertEqual(720, info2.video.video_width)
+
+        # replaced files are probed again
+        shutil.copy('test1.ogg', self.video_file_path)
+        self.assertEqual('ogg', c.probe(self.video_file_path).format.format)
+        shutil.copy('test.mp3', self.video_file_path)
+        self.assertEqual('mp3', c.probe(self.video_file_path).format.format)
+
     def test_probe_audio_poster(self):
         c = Converter()
 